@@ -5,7 +5,9 @@ with open('README.md', 'r') as f:
 
 requires = [
     'keyring',
-    'ShopifyAPI'
+    'orjson',
+    'ShopifyAPI',
+    'urllib3>=1.26'
 ]
 
 setup(
@@ -24,5 +26,5 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.8',
 )
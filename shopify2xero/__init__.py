@@ -1,28 +1,160 @@
+from __future__ import annotations
+
+import asyncio
 import datetime
+import functools
 import itertools
-import json
 import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Iterable, List, NamedTuple, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
-import keyring
+import orjson
 import shopify
+from pyactiveresource.connection import ConnectionError as ShopifyConnectionError
+from pyactiveresource.connection import ServerError as ShopifyServerError
 from shopify import mixins
-from xero_python.accounting import AccountingApi
-from xero_python.accounting.models.contact import Contact
-from xero_python.accounting.models.contacts import Contacts
-from xero_python.accounting.models.invoice import Invoice
-from xero_python.accounting.models.invoices import Invoices
-from xero_python.accounting.models.item import Item
-from xero_python.accounting.models.line_item import LineItem
-from xero_python.api_client import ApiClient
-from xero_python.api_client import Configuration
-from xero_python.api_client.oauth2 import OAuth2Token
-from xero_python.identity import IdentityApi
+from shopify.collection import PaginatedCollection
+
+# xero_python, keyring and urllib3 are imported where they are used so that importing the package, or only working
+# with Shopify, does not pay for loading them. shopify is needed up front for the Payout and Transaction resources
+if TYPE_CHECKING:
+    from xero_python.accounting import AccountingApi
+    from xero_python.accounting.models.contact import Contact
+    from xero_python.accounting.models.invoice import Invoice
+    from xero_python.accounting.models.item import Item
+    from xero_python.api_client import ApiClient
+    from xero_python.identity import IdentityApi
 
 logger = logging.getLogger(__name__)
 
 SHOPIFY_API_VERSION = '2021-10'
+# Keep well within the Shopify REST leaky bucket when fetching resources in parallel
+SHOPIFY_MAX_CONCURRENT_REQUESTS = 4
+# The maximum number of IDs accepted by the GraphQL `nodes` query
+SHOPIFY_GRAPHQL_MAX_NODES = 250
+# Seconds to wait between checks on the status of a Shopify bulk operation
+SHOPIFY_BULK_OPERATION_POLL_INTERVAL = 1
+# Seconds by which consecutive cached customer fetches overlap, in case our clock is ahead of Shopify's
+SHOPIFY_CUSTOMER_CACHE_OVERLAP = 300
+# Xero recommends sending at most 50 elements per create request
+XERO_MAX_INVOICES_PER_REQUEST = 50
+# Keep `where` filters short enough for the request URL
+XERO_MAX_WHERE_CLAUSES = 50
+# Xero limits each tenant to 5 concurrent requests
+XERO_MAX_CONCURRENT_REQUESTS = 5
+XERO_CONTACTS_PAGE_SIZE = 100
+# Connections to keep alive to the Xero API between requests
+XERO_CONNECTION_POOL_MAXSIZE = 8
+# Seconds before expiry at which the cached Xero token is reread in case another process has refreshed it
+XERO_TOKEN_EXPIRY_MARGIN = 300
+# Seconds before expiry at which the Xero token is refreshed in the background, ahead of the margin above
+XERO_TOKEN_REFRESH_MARGIN = 600
+# Seconds to wait after a failed background refresh before trying again
+XERO_TOKEN_REFRESH_RETRY_INTERVAL = 300
+
+# Responses from either API that mean the request was not processed and should be retried after a wait
+RETRY_STATUSES = (429, 503)
+RETRY_MAX_ATTEMPTS = 5
+# Xero's per-minute limit asks for waits of up to a minute. Its daily limit is handled separately
+RETRY_MAX_WAIT = 60
+
+
+def _retry_on_rate_limit(func):
+    """
+    Retry calls to Shopify or Xero that were rate limited, waiting for as long as the `Retry-After` header asks or
+    otherwise backing off exponentially with jitter. Any other error, or a limit that would take longer than
+    `RETRY_MAX_WAIT` to reset, is raised immediately
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                status, headers = _get_error_status_and_headers(e)
+                if status not in RETRY_STATUSES or attempt == RETRY_MAX_ATTEMPTS:
+                    raise
+
+                # Xero's daily limit resets hours later so fail rather than hang until then
+                if (_get_header(headers, 'X-Rate-Limit-Problem') or '').lower() == 'day':
+                    raise
+
+                retry_after = _parse_retry_after(_get_header(headers, 'Retry-After'))
+                if retry_after is None:
+                    wait = min(2 ** (attempt - 1) + random.random(), RETRY_MAX_WAIT)
+                elif retry_after > RETRY_MAX_WAIT:
+                    raise
+                else:
+                    wait = retry_after
+
+                logger.warning(f'{func.__name__} failed with status {status}, retrying in {wait:.1f} seconds')
+                time.sleep(wait)
+
+    return wrapper
+
+
+def _get_header(headers: Optional[dict], name: str) -> Optional[str]:
+    name = name.lower()
+    return next((value for key, value in (headers or {}).items() if key.lower() == name), None)
+
+
+def _parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+    """Return the number of seconds to wait, or None if there is no header or it is an HTTP date"""
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ShopifyGraphQLThrottled(RuntimeError):
+    """Shopify reports a throttled GraphQL query in the response body rather than with a 429"""
+
+
+def _get_error_status_and_headers(e: Exception) -> tuple:
+    if isinstance(e, ShopifyConnectionError):
+        return getattr(e.response, 'code', None), getattr(e.response, 'headers', None)
+
+    # pyactiveresource raises ServerError for 5xx responses, without the headers
+    if isinstance(e, ShopifyServerError):
+        return getattr(e, 'code', None), None
+
+    # Raised by shopify.GraphQL for any unsuccessful response
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code, e.headers
+
+    if isinstance(e, ShopifyGraphQLThrottled):
+        return 429, None
+
+    # Only Xero calls raise ApiException, and they have already imported xero_python
+    xero_exceptions = sys.modules.get('xero_python.exceptions')
+    if xero_exceptions is not None and isinstance(e, xero_exceptions.ApiException):
+        return e.status, e.headers
+
+    return None, None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_keyring():
+    """Resolve the keyring backend once per process so that it, and any connection it holds, is reused"""
+    import keyring
+    return keyring.get_keyring()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_xoauth_config() -> dict:
+    """Read the xoauth config once per process, as it is shared by every connection and rarely changes"""
+    with open(Path.home() / '.xoauth' / 'xoauth.json', 'rb') as f:
+        return orjson.loads(f.read())
 
 
 class PayoutSummary(NamedTuple):
@@ -43,6 +175,10 @@ class Transaction(shopify.ShopifyResource, mixins.Metafields):
 
 
 class Shopify2Xero:
+    # Xero tokens are refreshed off the request path, one at a time across all instances
+    _xero_token_refresh_executor = ThreadPoolExecutor(max_workers=1)
+    _xero_token_refresh_lock = threading.Lock()
+
     def __init__(
             self,
             xoauth_connection_name: str,
@@ -53,47 +189,252 @@ class Shopify2Xero:
         self.shopify_shop_url = shopify_shop_url
         self.shopify_access_token = shopify_access_token
         self.customer_shipping_account_code = customer_shipping_account_code
-
-        with open(Path.home() / '.xoauth' / 'xoauth.json', 'r') as f:
-            xoauth_config = json.load(f)
-
-        self.xero_scopes = xoauth_config[xoauth_connection_name]['Scopes']
-
-        xero_client_id = xoauth_config[xoauth_connection_name]['ClientId']
-        xero_client_secret = keyring.get_password('com.xero.xoauth', xoauth_connection_name)
+        self._shopify_session = shopify.Session(shopify_shop_url, SHOPIFY_API_VERSION, shopify_access_token)
+        self._token_keyring_key = f'{xoauth_connection_name}:token_set'
+        # The ApiClient asks for the token before every request so keep it in memory rather than reading the keyring
+        self._cached_xero_oauth2_token = None
+        self._xero_token_refresh = None
+        self._xero_token_refresh_failed_at = None
+
+    # The Xero client is built lazily so that constructing a Shopify2Xero does not read the xoauth config or keyring,
+    # or call the Xero API, until a Xero operation actually needs it
+    @functools.cached_property
+    def _xoauth_config(self) -> dict:
+        return _load_xoauth_config()[self.xoauth_connection_name]
+
+    @functools.cached_property
+    def xero_scopes(self) -> List[str]:
+        return self._xoauth_config['Scopes']
+
+    @functools.cached_property
+    def xero_api_client(self) -> ApiClient:
+        from urllib3.util.retry import Retry
+        from xero_python.api_client import ApiClient
+        from xero_python.api_client import Configuration
+        from xero_python.api_client.oauth2 import OAuth2Token
+
+        xero_client_id = self._xoauth_config['ClientId']
+        xero_client_secret = _get_keyring().get_password('com.xero.xoauth', self.xoauth_connection_name)
 
         oauth2_token = OAuth2Token(client_id=xero_client_id, client_secret=xero_client_secret)
 
-        self.xero_api_client = ApiClient(
-            configuration=Configuration(oauth2_token=oauth2_token),
+        xero_configuration = Configuration(oauth2_token=oauth2_token)
+        # Read when the ApiClient creates its urllib3 PoolManager, which is then reused for every request
+        xero_configuration.connection_pool_maxsize = XERO_CONNECTION_POOL_MAXSIZE
+
+        xero_api_client = ApiClient(
+            configuration=xero_configuration,
             oauth2_token_saver=self.set_xero_oauth2_token,
             oauth2_token_getter=self.get_xero_oauth2_token
         )
 
-        self.xero_tenant_id = IdentityApi(self.xero_api_client).get_connections()[0].tenant_id
+        # xero_python does not pass retries through from its Configuration, so set the default for the connection
+        # pools directly. The pools are created on first use so this applies to every request. Only reads are
+        # retried, as xero_python sends creates as PUTs that Xero may already have applied when a 502 or read timeout
+        # comes back
+        xero_api_client.rest_client.pool_manager.connection_pool_kw['retries'] = Retry(
+            total=3,
+            backoff_factor=0.5,
+            # Rate limits are left to _retry_on_rate_limit, which gives up rather than wait hours for a daily limit.
+            # urllib3 would otherwise retry any 429 or 503 that has a Retry-After header, however long it asks for
+            status_forcelist=[502, 504],
+            respect_retry_after_header=False,
+            allowed_methods=frozenset({'GET'}),
+            # Let the final response through so that xero_python raises its usual ApiException
+            raise_on_status=False
+        )
 
-    def get_xero_oauth2_token(self) -> dict:
-        token = json.loads(
-            keyring.get_password('com.xero.xoauth', f'{self.xoauth_connection_name}:token_set')
+        return xero_api_client
+
+    @functools.cached_property
+    def accounting_api(self) -> AccountingApi:
+        from xero_python.accounting import AccountingApi
+        return AccountingApi(self.xero_api_client)
+
+    @functools.cached_property
+    def identity_api(self) -> IdentityApi:
+        from xero_python.identity import IdentityApi
+        return IdentityApi(self.xero_api_client)
+
+    @functools.cached_property
+    def xero_tenant_id(self) -> str:
+        return _retry_on_rate_limit(self.identity_api.get_connections)()[0].tenant_id
+
+    @contextmanager
+    def _with_shopify_session(self):
+        """
+        Activate the Shopify session for the duration of the block. Nested uses are no-ops so that bulk operations
+        only activate the session once rather than once per API call
+        """
+        # The active session is shared by every instance on the thread, so check that it is this instance's rather
+        # than remembering whether this instance activated it
+        if (
+                shopify.ShopifyResource.site == self._shopify_session.site
+                and shopify.ShopifyResource.get_headers().get('X-Shopify-Access-Token') == self._shopify_session.token
+        ):
+            yield
+            return
+
+        # As per shopify.Session.temp but reusing the same Session and restoring the previous one even on error
+        previous_session = shopify.Session(
+            shopify.ShopifyResource.url,
+            shopify.ShopifyResource.get_version() or SHOPIFY_API_VERSION,
+            shopify.ShopifyResource.get_headers().get('X-Shopify-Access-Token')
         )
-        token['scope'] = self.xero_scopes
+        shopify.ShopifyResource.activate_session(self._shopify_session)
+        try:
+            yield
+        finally:
+            shopify.ShopifyResource.activate_session(previous_session)
+
+    @_retry_on_rate_limit
+    def _shopify_graphql(self, query: str, variables: Optional[dict] = None) -> dict:
+        with self._with_shopify_session():
+            response = orjson.loads(shopify.GraphQL().execute(query, variables=variables))
+
+        if 'errors' in response:
+            # Some errors, e.g. an invalid access token, are a single message rather than a list
+            errors = response['errors'] if isinstance(response['errors'], list) else []
+            if any((error.get('extensions') or {}).get('code') == 'THROTTLED' for error in errors):
+                raise ShopifyGraphQLThrottled(f'Shopify GraphQL query was throttled: {response["errors"]}')
+            raise RuntimeError(f'Shopify GraphQL query failed: {response["errors"]}')
+
+        return response['data']
+
+    def _iter_all_shopify_resources(self, resource: type, **kwargs) -> Iterator[shopify.ShopifyResource]:
+        """
+        Iterate over every page of a Shopify resource, fetching the next page in the background while the current one is
+        consumed so that at most two pages are held in memory at a time. The Shopify session is only active while a
+        page is fetched, so the caller may use other sessions between items
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with self._with_shopify_session():
+                page = _retry_on_rate_limit(resource.find)(**kwargs)
+            while True:
+                next_page = executor.submit(self._get_next_shopify_page, page) if page.has_next_page() else None
+                yield from page
+                if next_page is None:
+                    return
+                page = next_page.result()
+
+    def _get_next_shopify_page(self, page: PaginatedCollection) -> PaginatedCollection:
+        # Runs on a worker thread which needs its own session. The page is not cached on the previous page so that
+        # earlier pages can be garbage collected
+        with self._with_shopify_session():
+            return _retry_on_rate_limit(page.next_page)(no_cache=True)
+
+    def _get_all_shopify_resources_concurrently(self, resource: type, **kwargs) -> List[shopify.ShopifyResource]:
+        """
+        Fetch every page of a Shopify resource using several cursors at once. A single cursor can only be followed one
+        page at a time so the resource is split into `created_at` ranges that are each paginated on their own thread.
+        The first and last ranges are open ended so that nothing is missed however the creation dates are distributed
+        """
+        with self._with_shopify_session():
+            oldest = _retry_on_rate_limit(resource.find)(since_id=0, limit=1, **kwargs)
+        if not oldest:
+            return []
+
+        # Each range also prefetches its next page on another thread
+        n_ranges = max(SHOPIFY_MAX_CONCURRENT_REQUESTS // 2, 1)
+        start = datetime.datetime.fromisoformat(oldest[0].created_at)
+        end = datetime.datetime.now(datetime.timezone.utc)
+        boundaries = [None] + [
+            (start + (end - start) * i / n_ranges).isoformat(timespec='seconds') for i in range(1, n_ranges)
+        ] + [None]
+
+        range_kwargs = []
+        for created_at_min, created_at_max in zip(boundaries, boundaries[1:]):
+            range_kwargs.append(dict(kwargs))
+            if created_at_min is not None:
+                range_kwargs[-1]['created_at_min'] = created_at_min
+            if created_at_max is not None:
+                range_kwargs[-1]['created_at_max'] = created_at_max
+
+        with ThreadPoolExecutor(max_workers=n_ranges) as executor:
+            ranges = executor.map(lambda k: list(self._iter_all_shopify_resources(resource, **k)), range_kwargs)
+            # The range limits are inclusive so anything created exactly on a boundary is returned twice
+            resources_by_id = {}
+            for resources in ranges:
+                for r in resources:
+                    resources_by_id.setdefault(r.id, r)
+
+        return list(resources_by_id.values())
+
+    def get_xero_oauth2_token(self) -> dict:
+        token = self._cached_xero_oauth2_token
+        # A revoked token is saved with expires_at set to None rather than removed
+        expires_at = token.get('expires_at') if token is not None else None
+        if token is None or (expires_at is not None and time.time() >= expires_at - XERO_TOKEN_EXPIRY_MARGIN):
+            token = orjson.loads(_get_keyring().get_password('com.xero.xoauth', self._token_keyring_key))
+            token['scope'] = self.xero_scopes
+            self._cached_xero_oauth2_token = token
+            expires_at = token.get('expires_at')
+
+        if expires_at is not None and time.time() >= expires_at - XERO_TOKEN_REFRESH_MARGIN:
+            self._refresh_xero_oauth2_token_in_background()
+
+        # The token is still valid even if a refresh is now in flight
         return token
 
+    def _refresh_xero_oauth2_token_in_background(self) -> None:
+        with self._xero_token_refresh_lock:
+            if self._xero_token_refresh is not None and not self._xero_token_refresh.done():
+                return
+            # Back off after a failure rather than asking the token endpoint again on every request
+            failed_at = self._xero_token_refresh_failed_at
+            if failed_at is not None and time.time() < failed_at + XERO_TOKEN_REFRESH_RETRY_INTERVAL:
+                return
+            self._xero_token_refresh = self._xero_token_refresh_executor.submit(self._refresh_xero_oauth2_token)
+
+    def _refresh_xero_oauth2_token(self) -> None:
+        # The refresh runs before the cached token would be reread, so drop it to start from the keyring's current
+        # token in case another process has already rotated the refresh token. The new token is passed to
+        # set_xero_oauth2_token, which updates the cache
+        self._cached_xero_oauth2_token = None
+        try:
+            self.xero_api_client.refresh_oauth2_token()
+        except Exception:
+            # Tried again once the backoff has passed. If the token expires first the ApiClient refreshes it itself
+            self._xero_token_refresh_failed_at = time.time()
+            logger.exception('Failed to refresh the Xero OAuth2 token in the background')
+        else:
+            self._xero_token_refresh_failed_at = None
+
     def set_xero_oauth2_token(self, xero_oauth2_token: dict) -> None:
-        keyring.set_password(
+        # Cache the refreshed token first so that it is not lost if writing to the keyring fails
+        self._cached_xero_oauth2_token = {**xero_oauth2_token, 'scope': self.xero_scopes}
+        _get_keyring().set_password(
             'com.xero.xoauth',
-            f'{self.xoauth_connection_name}:token_set',
-            json.dumps(xero_oauth2_token)
+            self._token_keyring_key,
+            orjson.dumps(xero_oauth2_token).decode()
+        )
+
+    # The Shopify and Xero clients are both blocking so the async variants run the calls on the event loop's default
+    # executor. This lets the two APIs be queried at the same time with asyncio.gather
+    async def aget_all_shopify_customers(self, use_cache: bool = False) -> List[shopify.Customer]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.get_all_shopify_customers, use_cache=use_cache)
+        )
+
+    async def aget_all_xero_contacts(
+            self,
+            since: Optional[datetime.datetime] = None,
+            summary_only: bool = True) -> List[Contact]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.get_all_xero_contacts, since=since, summary_only=summary_only)
         )
 
     def copy_customer(self, customer_id: int, update: bool = False) -> Contact:
+        from xero_python.accounting.models.contact import Contact
+        from xero_python.accounting.models.contacts import Contacts
+
         customer = self.get_shopify_customer(customer_id)
 
         existing_contact = None
         if update:
             existing_contact = next(
                 iter(
-                    AccountingApi(self.xero_api_client).get_contacts(
+                    _retry_on_rate_limit(self.accounting_api.get_contacts)(
                         xero_tenant_id=self.xero_tenant_id,
                         where=f'name="{customer.first_name.strip()} {customer.last_name.strip()}"'
                     ).contacts
@@ -111,39 +452,79 @@ class Shopify2Xero:
         )
 
         if existing_contact is not None:
-            AccountingApi(self.xero_api_client).update_contact(
+            _retry_on_rate_limit(self.accounting_api.update_contact)(
                 xero_tenant_id=self.xero_tenant_id,
                 contact_id=existing_contact.contact_id,
                 contacts=Contacts(contacts=[new_contact])
             )
         else:
-            AccountingApi(self.xero_api_client).create_contacts(
+            _retry_on_rate_limit(self.accounting_api.create_contacts)(
                 xero_tenant_id=self.xero_tenant_id,
                 contacts=Contacts(contacts=[new_contact])
             )
 
         return new_contact
 
-    def copy_order(self, order_id: int, deleted_products_map: Optional[Dict[str, str]] = None) -> None:
+    def copy_order(
+            self,
+            order_id: int,
+            deleted_products_map: Optional[Dict[str, str]] = None,
+            variant_id_to_sku_map: Optional[Dict[int, str]] = None) -> None:
         """
         Create a Xero invoice from a Shopify order
         :param order_id: The Shopify order ID corresponding to the order to copy
         :param deleted_products_map: An explicit map from Shopify product name to Xero item code to allow for products
         that have been deleted from Shopify
+        :param variant_id_to_sku_map: A precomputed map from Shopify variant ID to SKU, as returned by
+        `get_shopify_variant_id_to_sku_map`. The SKUs of any variants in the order that are missing from the map are
+        fetched and added to it
         :return: Nothing
         """
+        new_invoice = self._build_invoice(
+            self.get_shopify_order(order_id),
+            deleted_products_map=deleted_products_map,
+            variant_id_to_sku_map=variant_id_to_sku_map
+        )
+        if new_invoice is not None:
+            self._create_xero_invoices([new_invoice])
+
+    def _build_invoice(
+            self,
+            order: shopify.Order,
+            deleted_products_map: Optional[Dict[str, str]] = None,
+            variant_id_to_sku_map: Optional[Dict[int, str]] = None,
+            customer_id_to_contact_map: Optional[Dict[int, Contact]] = None) -> Optional[Invoice]:
+        """
+        Build, but do not create, the Xero invoice for a Shopify order, creating the Xero contact if necessary
+        :param customer_id_to_contact_map: Prefetched Xero contacts keyed by Shopify customer ID, as returned by
+        `get_xero_contacts_for_shopify_customers`. Contacts looked up or created for the order are added to it
+        :return: The new invoice or None if the invoice already exists in Xero
+        """
+        from xero_python.accounting.models.invoice import Invoice
+        from xero_python.accounting.models.line_item import LineItem
+
         if deleted_products_map is None:
             deleted_products_map = {}
 
-        logger.debug(f'Copying order {order_id}')
-        order = self.get_shopify_order(order_id)
+        logger.debug(f'Copying order {order.id}')
         invoice_number = f'INV-SHOPIFY-{order.order_number}'
         existing_invoice = self.get_xero_invoice(invoice_number)
         if existing_invoice is not None:
             logger.warning(f'Invoice {invoice_number} already exists')
-            return
+            return None
+
+        if variant_id_to_sku_map is None:
+            variant_id_to_sku_map = {}
+        # Only look up the variants this order needs that are not already known, e.g. variants created since a
+        # precomputed map was built
+        missing_variant_ids = {
+            line_item.variant_id
+            for line_item in order.line_items
+            if line_item.variant_id is not None and line_item.variant_id not in variant_id_to_sku_map
+        }
+        if missing_variant_ids:
+            variant_id_to_sku_map.update(self.get_shopify_variant_skus(missing_variant_ids))
 
-        variant_id_to_sku_map = {variant.id: variant.sku for variant in self.get_all_shopify_variants()}
         for line_item in order.line_items:
             if line_item.variant_id is None:
                 # A deleted product
@@ -154,22 +535,31 @@ class Shopify2Xero:
             elif variant_id_to_sku_map[line_item.variant_id] == '':
                 raise ValueError(f'SKU must be set in Shopify for {line_item.name}')
 
-        contact = next(
-            iter(
-                AccountingApi(self.xero_api_client).get_contacts(
-                    xero_tenant_id=self.xero_tenant_id,
-                    where=f'name="{order.customer.first_name.strip()} {order.customer.last_name.strip()}"'
-                ).contacts
-            ),
-            None
-        )
+        contact = None
+        if customer_id_to_contact_map is not None:
+            contact = customer_id_to_contact_map.get(order.customer.id)
+        if contact is None:
+            # Fall back to matching by name for contacts that were not created by `copy_customer`
+            contact = next(
+                iter(
+                    _retry_on_rate_limit(self.accounting_api.get_contacts)(
+                        xero_tenant_id=self.xero_tenant_id,
+                        where=f'name="{order.customer.first_name.strip()} {order.customer.last_name.strip()}"'
+                    ).contacts
+                ),
+                None
+            )
         if contact is None:
             contact = self.copy_customer(order.customer.id)
+        if customer_id_to_contact_map is not None:
+            customer_id_to_contact_map[order.customer.id] = contact
 
         if any(line_item.discount_allocations for line_item in itertools.chain(order.line_items, order.shipping_lines)):
-            logger.debug(f'Order {order_id} ({order.order_number}) has discounts')
+            logger.debug(f'Order {order.id} ({order.order_number}) has discounts')
+
+        processed_at = datetime.datetime.fromisoformat(order.processed_at)
 
-        new_invoice = Invoice(
+        return Invoice(
             type='ACCREC',
             contact=contact,
             line_items=[
@@ -178,9 +568,9 @@ class Shopify2Xero:
                     item_code=variant_id_to_sku_map.get(line_item.variant_id, deleted_products_map.get(line_item.name)),
                     quantity=line_item.quantity,
                     unit_amount=line_item.price,
-                    discount_amount=sum(
+                    discount_amount=math.fsum([
                         float(discount_allocation.amount) for discount_allocation in line_item.discount_allocations
-                    )
+                    ])
                 )
                 for line_item in order.line_items
             ] + [
@@ -189,33 +579,64 @@ class Shopify2Xero:
                     quantity=1,
                     unit_amount=shipping_line.price,
                     account_code=self.customer_shipping_account_code,
-                    discount_amount=sum(
+                    discount_amount=math.fsum([
                         float(discount_allocation.amount) for discount_allocation in shipping_line.discount_allocations
-                    )
+                    ])
                 )
                 for shipping_line in order.shipping_lines
             ],
-            date=datetime.datetime.strptime(
-                order.processed_at[:-3] + order.processed_at[-2:],
-                '%Y-%m-%dT%H:%M:%S%z'
-            ),
-            due_date=datetime.datetime.strptime(
-                order.processed_at[:-3] + order.processed_at[-2:],
-                '%Y-%m-%dT%H:%M:%S%z'
-            ),
+            date=processed_at,
+            due_date=processed_at,
             invoice_number=invoice_number,
             status='AUTHORISED'
         )
 
-        AccountingApi(self.xero_api_client).create_invoices(
-            xero_tenant_id=self.xero_tenant_id,
-            invoices=Invoices(invoices=[new_invoice])
-        )
-        logger.info(f'Created invoice {invoice_number}')
+    def _create_xero_invoices(self, invoices: List[Invoice]) -> None:
+        from xero_python.accounting.models.invoices import Invoices
+
+        for i in range(0, len(invoices), XERO_MAX_INVOICES_PER_REQUEST):
+            batch = invoices[i:i + XERO_MAX_INVOICES_PER_REQUEST]
+            _retry_on_rate_limit(self.accounting_api.create_invoices)(
+                xero_tenant_id=self.xero_tenant_id,
+                invoices=Invoices(invoices=batch)
+            )
+            for invoice in batch:
+                logger.info(f'Created invoice {invoice.invoice_number}')
+
+    def copy_orders(self, order_ids: Iterable[int], **kwargs) -> List[shopify.Order]:
+        """
+        Create Xero invoices from several Shopify orders
+        :param order_ids: The Shopify order IDs corresponding to the orders to copy. Repeated IDs are copied once
+        :param kwargs: Passed through to `_build_invoice`, i.e. `deleted_products_map`, `variant_id_to_sku_map` and
+            `customer_id_to_contact_map`. The last two are looked up for the whole batch if not given
+        :return: The Shopify orders, including those whose invoices already existed
+        """
+        # Every invoice is built before any is created, so a repeated order would pass the existing invoice check twice
+        order_ids = list(dict.fromkeys(order_ids))
+
+        with self._with_shopify_session():
+            # The Shopify fetches are independent so overlap them, but build the invoices one order at a time so that
+            # repeat customers are not created twice as Xero contacts
+            orders = self.get_shopify_orders(order_ids)
+
+            # Look up the SKUs for every variant in the batch at once rather than once per order
+            if kwargs.get('variant_id_to_sku_map') is None:
+                kwargs['variant_id_to_sku_map'] = self.get_shopify_variant_skus(
+                    line_item.variant_id
+                    for order in orders
+                    for line_item in order.line_items
+                    if line_item.variant_id is not None
+                )
+
+            if kwargs.get('customer_id_to_contact_map') is None:
+                kwargs['customer_id_to_contact_map'] = self.get_xero_contacts_for_shopify_customers(
+                    order.customer.id for order in orders
+                )
 
-    def copy_orders(self, order_ids: Iterable[int], **kwargs) -> None:
-        for order_id in order_ids:
-            self.copy_order(order_id, **kwargs)
+            new_invoices = [self._build_invoice(order, **kwargs) for order in orders]
+
+        self._create_xero_invoices([invoice for invoice in new_invoices if invoice is not None])
+        return orders
 
     def copy_all_orders_for_payout(
             self,
@@ -225,61 +646,178 @@ class Shopify2Xero:
         if (payout_id is None) == (payout_date is None):
             raise ValueError('Exactly one of `payout_id` and `payout_date` must be provided')
 
-        if payout_id is None:
-            payout = self.get_shopify_payout_by_date(payout_date)
+        with self._with_shopify_session():
+            if payout_id is None:
+                payout = self.get_shopify_payout_by_date(payout_date)
+            else:
+                payout = self.get_shopify_payout(payout_id)
+
+            transactions = self.get_shopify_payout_transactions(payout.id)
+            order_ids = {t.source_order_id for t in transactions if t.source_order_id is not None}
+            orders = self.copy_orders(sorted(order_ids), **kwargs)
+            return PayoutSummary(
+                date=payout.date,
+                payout_amount=payout.amount,
+                order_numbers=sorted(order.order_number for order in orders),
+                total_fees=math.fsum([float(t.fee) for t in transactions])
+            )
+
+    def get_all_shopify_customers(self, use_cache: bool = False) -> List[shopify.Customer]:
+        """
+        Fetch every Shopify customer
+        :param use_cache: Keep the customers in a cache under ~/.shopify2xero so that subsequent calls only fetch
+        customers that have been updated since. Note that customers deleted from Shopify remain in the cache
+        :return: The customers
+        """
+        if not use_cache:
+            return self._get_all_shopify_resources_concurrently(shopify.Customer)
+
+        cache_path = Path.home() / '.shopify2xero' / f'{self._shopify_session.url}.customers.json'
+        cache = {'last_updated_at': None, 'customers': []}
+        if cache_path.exists():
+            with open(cache_path, 'rb') as f:
+                cache = orjson.loads(f.read())
+
+        # The next fetch starts from when this one did rather than from the latest update it saw. A customer whose page
+        # was read before they were updated can otherwise have an earlier updated_at than one read after, and their
+        # update would never be fetched. Customers fetched again are merged by ID
+        last_updated_at = (
+            datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(seconds=SHOPIFY_CUSTOMER_CACHE_OVERLAP)
+        ).isoformat(timespec='seconds')
+
+        if cache['last_updated_at'] is None:
+            updated_customers = self._get_all_shopify_resources_concurrently(shopify.Customer)
         else:
-            payout = self.get_shopify_payout(payout_id)
-
-        transactions = self.get_shopify_payout_transactions(payout.id)
-        order_ids = {t.source_order_id for t in transactions if t.source_order_id is not None}
-        self.copy_orders(order_ids, **kwargs)
-        return PayoutSummary(
-            date=payout.date,
-            payout_amount=payout.amount,
-            order_numbers=sorted(self.get_shopify_order(order_id).order_number for order_id in order_ids),
-            total_fees=sum(float(t.fee) for t in transactions)
-        )
+            updated_customers = self._get_all_shopify_resources_concurrently(
+                shopify.Customer,
+                updated_at_min=cache['last_updated_at']
+            )
 
-    def get_all_shopify_customers(self) -> List[shopify.Customer]:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
-            return list(shopify.Customer.find(no_iter_next=False))
+        # Constructing a resource reads the site from the active session
+        with self._with_shopify_session():
+            customers_by_id = {
+                customer['id']: shopify.Customer(customer) for customer in cache['customers']
+            }
+        for customer in updated_customers:
+            customers_by_id[customer.id] = customer
+
+        # Write to a temporary file first so that an interrupted write cannot corrupt the cache. The cache holds
+        # customers' personal details so only the current user may read it
+        cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        temporary_cache_path = cache_path.with_suffix('.tmp')
+        # The permissions are only applied when the file is created, so remove any left by an interrupted write
+        temporary_cache_path.unlink(missing_ok=True)
+        fd = os.open(temporary_cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'wb') as f:
+            f.write(orjson.dumps({
+                'last_updated_at': last_updated_at,
+                'customers': [customer.to_dict() for customer in customers_by_id.values()]
+            }))
+        os.replace(temporary_cache_path, cache_path)
+
+        return list(customers_by_id.values())
+
+    def get_all_shopify_customers_and_xero_contacts(self) -> Tuple[List[shopify.Customer], List[Contact]]:
+        """Fetch every Shopify customer and every Xero contact, querying both APIs at the same time"""
+        # Both clients are blocking so threads are enough, and unlike asyncio.run this works inside a running event loop
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            customers = executor.submit(self.get_all_shopify_customers)
+            contacts = executor.submit(self.get_all_xero_contacts)
+            return customers.result(), contacts.result()
 
     def get_all_shopify_orders(self) -> List[shopify.Order]:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
-            return list(shopify.Order.find(no_iter_next=False, status='any'))
+        return list(self.iter_all_shopify_orders())
 
     def get_all_shopify_payouts(self) -> List[Payout]:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
-            return list(Payout.find(no_iter_next=False))
+        return list(self.iter_all_shopify_payouts())
 
     def get_all_shopify_products(self) -> List[shopify.Product]:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
-            return list(shopify.Product.find(no_iter_next=False))
+        return list(self.iter_all_shopify_products())
 
     def get_all_shopify_variants(self) -> List[shopify.Variant]:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
-            return list(shopify.Variant.find(no_iter_next=False))
+        return list(self.iter_all_shopify_variants())
 
-    def get_all_xero_contacts(self) -> List[Contact]:
-        return AccountingApi(self.xero_api_client).get_contacts(xero_tenant_id=self.xero_tenant_id).contacts
+    def get_all_xero_contacts(
+            self,
+            since: Optional[datetime.datetime] = None,
+            summary_only: bool = True) -> List[Contact]:
+        """
+        Fetch every Xero contact in a single request
+        :param since: If given, only fetch the contacts created or modified since then
+        :param summary_only: Whether to fetch the lightweight version of each contact
+        """
+        from xero_python.exceptions import ApiException
+
+        kwargs = {'summary_only': summary_only}
+        if since is not None:
+            kwargs['if_modified_since'] = since
+
+        try:
+            return _retry_on_rate_limit(self.accounting_api.get_contacts)(
+                xero_tenant_id=self.xero_tenant_id,
+                **kwargs
+            ).contacts
+        except ApiException as e:
+            # Xero may answer Not Modified when no contact has changed since then
+            if since is not None and e.status == 304:
+                return []
+            raise
+
+    def get_all_xero_contacts_paged(self, summary_only: bool = True) -> List[Contact]:
+        """
+        Fetch every Xero contact a page at a time, requesting several pages at once. The number of pages is not known
+        up front so pages are requested in batches until one of them comes back short
+        :param summary_only: Whether to fetch the lightweight version of each contact
+        """
+        def get_page(page: int) -> List[Contact]:
+            return _retry_on_rate_limit(self.accounting_api.get_contacts)(
+                xero_tenant_id=self.xero_tenant_id,
+                page=page,
+                page_size=XERO_CONTACTS_PAGE_SIZE,
+                summary_only=summary_only
+            ).contacts
+
+        contacts = get_page(1)
+        if len(contacts) < XERO_CONTACTS_PAGE_SIZE:
+            return contacts
+
+        # The threads share the ApiClient's connection pool, which is large enough for all of them
+        with ThreadPoolExecutor(max_workers=XERO_MAX_CONCURRENT_REQUESTS) as executor:
+            first_page = 2
+            while True:
+                pages = list(executor.map(get_page, range(first_page, first_page + XERO_MAX_CONCURRENT_REQUESTS)))
+                for page in pages:
+                    contacts.extend(page)
+                if any(len(page) < XERO_CONTACTS_PAGE_SIZE for page in pages):
+                    return contacts
+                first_page += XERO_MAX_CONCURRENT_REQUESTS
 
     def get_all_xero_items(self) -> List[Item]:
-        return AccountingApi(self.xero_api_client).get_items(xero_tenant_id=self.xero_tenant_id).items
+        return _retry_on_rate_limit(self.accounting_api.get_items)(xero_tenant_id=self.xero_tenant_id).items
 
+    @_retry_on_rate_limit
     def get_shopify_customer(self, customer_id: int) -> shopify.Customer:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
+        with self._with_shopify_session():
             return shopify.Customer.find(id_=customer_id)
 
+    @_retry_on_rate_limit
     def get_shopify_order(self, order_id: int) -> shopify.Order:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
+        with self._with_shopify_session():
             return shopify.Order.find(id_=order_id)
 
+    def get_shopify_orders(self, order_ids: Iterable[int]) -> List[shopify.Order]:
+        with ThreadPoolExecutor(max_workers=SHOPIFY_MAX_CONCURRENT_REQUESTS) as executor:
+            return list(executor.map(self.get_shopify_order, order_ids))
+
+    @_retry_on_rate_limit
     def get_shopify_payout(self, payout_id: int) -> Payout:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
+        with self._with_shopify_session():
             return Payout.find(id_=payout_id)
 
+    @_retry_on_rate_limit
     def get_shopify_payout_by_date(self, date: str) -> Payout:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
+        with self._with_shopify_session():
             payouts = Payout.find(no_iter_next=False, date=date)
 
         if len(payouts) == 1:
@@ -287,21 +825,119 @@ class Shopify2Xero:
         else:
             raise ValueError(f'Unexpected number of payouts found on {date}: {len(payouts)}')
 
+    @_retry_on_rate_limit
     def get_shopify_variant(self, variant_id: int) -> shopify.Variant:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
+        with self._with_shopify_session():
             return shopify.Variant.find(id_=variant_id)
 
+    def get_shopify_variant_skus(self, variant_ids: Iterable[int]) -> Dict[int, str]:
+        """
+        Fetch the SKUs of specific Shopify variants without fetching the rest of each variant or the whole catalog
+        :param variant_ids: The Shopify variant IDs to look up
+        :return: A map from Shopify variant ID to SKU. Variants that no longer exist are omitted
+        """
+        variant_ids = sorted(set(variant_ids))
+        variant_id_to_sku_map = {}
+        for i in range(0, len(variant_ids), SHOPIFY_GRAPHQL_MAX_NODES):
+            data = self._shopify_graphql(
+                'query($ids: [ID!]!) { nodes(ids: $ids) { ... on ProductVariant { legacyResourceId sku } } }',
+                variables={
+                    'ids': [
+                        f'gid://shopify/ProductVariant/{variant_id}'
+                        for variant_id in variant_ids[i:i + SHOPIFY_GRAPHQL_MAX_NODES]
+                    ]
+                }
+            )
+            for node in data['nodes']:
+                if node is not None:
+                    # GraphQL returns null rather than an empty string for a missing SKU
+                    variant_id_to_sku_map[int(node['legacyResourceId'])] = node['sku'] or ''
+
+        return variant_id_to_sku_map
+
+    def get_shopify_variant_id_to_sku_map(self) -> Dict[int, str]:
+        """
+        Fetch the SKU of every Shopify variant. A GraphQL bulk operation is used so that only the ID and SKU of each
+        variant are transferred and the catalog is not subject to the usual API rate limits
+        :return: A map from Shopify variant ID to SKU
+        """
+        result = self._shopify_graphql(
+            'mutation {'
+            '  bulkOperationRunQuery(query: """{ productVariants { edges { node { legacyResourceId sku } } } }""") {'
+            '    userErrors { field message }'
+            '  }'
+            '}'
+        )['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise RuntimeError(f'Shopify bulk operation could not be started: {result["userErrors"]}')
+
+        while True:
+            time.sleep(SHOPIFY_BULK_OPERATION_POLL_INTERVAL)
+            bulk_operation = self._shopify_graphql(
+                '{ currentBulkOperation { status errorCode url } }'
+            )['currentBulkOperation']
+            if bulk_operation['status'] == 'COMPLETED':
+                break
+            elif bulk_operation['status'] not in ('CREATED', 'RUNNING'):
+                raise RuntimeError(
+                    f'Shopify bulk operation {bulk_operation["status"].lower()}: {bulk_operation["errorCode"]}'
+                )
+
+        # There is no results file when the shop has no variants
+        if bulk_operation['url'] is None:
+            return {}
+
+        with urllib.request.urlopen(bulk_operation['url']) as response:
+            return {
+                int(variant['legacyResourceId']): variant['sku'] or ''
+                for variant in map(orjson.loads, response)
+            }
+
     def get_shopify_payout_transactions(self, payout_id: int) -> List[Transaction]:
-        with shopify.Session.temp(domain=self.shopify_shop_url, version=SHOPIFY_API_VERSION, token=self.shopify_access_token):
-            return list(Transaction.find(payout_id=payout_id, no_iter_next=False))
+        return list(self._iter_all_shopify_resources(Transaction, payout_id=payout_id))
+
+    def get_xero_contacts_for_shopify_customers(self, customer_ids: Iterable[int]) -> Dict[int, Contact]:
+        """
+        Find the Xero contacts created by `copy_customer` for the given Shopify customers
+        :param customer_ids: The Shopify customer IDs to look up
+        :return: A map from Shopify customer ID to Xero contact. Customers without a contact are omitted
+        """
+        customer_ids = sorted(set(customer_ids))
+        customer_id_to_contact_map = {}
+        for i in range(0, len(customer_ids), XERO_MAX_WHERE_CLAUSES):
+            contacts = _retry_on_rate_limit(self.accounting_api.get_contacts)(
+                xero_tenant_id=self.xero_tenant_id,
+                where=' OR '.join(
+                    f'ContactNumber=="{customer_id}"' for customer_id in customer_ids[i:i + XERO_MAX_WHERE_CLAUSES]
+                )
+            ).contacts
+            for contact in contacts:
+                customer_id_to_contact_map[int(contact.contact_number)] = contact
+
+        return customer_id_to_contact_map
 
     def get_xero_invoice(self, invoice_number: str) -> Optional[Invoice]:
         return next(
             iter(
-                AccountingApi(self.xero_api_client).get_invoices(
+                _retry_on_rate_limit(self.accounting_api.get_invoices)(
                     xero_tenant_id=self.xero_tenant_id,
                     invoice_numbers=[invoice_number]
                 ).invoices
             ),
             None
         )
+
+    def iter_all_shopify_customers(self) -> Iterator[shopify.Customer]:
+        return self._iter_all_shopify_resources(shopify.Customer)
+
+    def iter_all_shopify_orders(self) -> Iterator[shopify.Order]:
+        return self._iter_all_shopify_resources(shopify.Order, status='any')
+
+    def iter_all_shopify_payouts(self) -> Iterator[Payout]:
+        return self._iter_all_shopify_resources(Payout)
+
+    def iter_all_shopify_products(self) -> Iterator[shopify.Product]:
+        return self._iter_all_shopify_resources(shopify.Product)
+
+    def iter_all_shopify_variants(self) -> Iterator[shopify.Variant]:
+        return self._iter_all_shopify_resources(shopify.Variant)